@@ -1,16 +1,25 @@
+import asyncio
+import copy
 import logging
 import os
-import json
+import random
 import httpx
+import orjson
 import re
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ChatAction
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
 
 import firebase_admin
-from firebase_admin import credentials, firestore
+from firebase_admin import credentials, firestore, firestore_async
+from google.api_core.exceptions import NotFound
 
 # --- 1. CONFIGURACIÓN INICIAL ---
 load_dotenv()
@@ -28,7 +37,7 @@ logger = logging.getLogger(__name__)
 try:
     cred = credentials.Certificate("firebase-credentials.json")
     firebase_app = firebase_admin.initialize_app(cred)
-    db = firestore.client()
+    db = firestore_async.client()
     logger.info("Firebase conectado exitosamente.")
 except Exception as e:
     logger.error(f"Error al conectar con Firebase: {e}. El bot funcionará sin base de datos.")
@@ -73,32 +82,153 @@ El cuaderno busca que el estudiante comprenda y aplique el concepto de derivada
     - Descripción de máximos y mínimos: Un máximo relativo ocurre si la función cambia de creciente a decreciente. Un mínimo, si cambia de decreciente a creciente.
 """
 
+CUADERNO_PROMPT_PREFIX = (
+    f"{CUADERNO_CONTEXT}\n\n---\n\nBasado en el contexto anterior del 'Cuaderno Digital', responde la siguiente duda del estudiante de la manera más clara y útil posible:\n\nPREGUNTA DEL ESTUDIANTE: "
+)
+
 MAIN_MENU_KEYBOARD = InlineKeyboardMarkup([[
     InlineKeyboardButton("« Volver al Menú Principal", callback_data="main_menu")
 ]])
+_TOPIC_CALLBACKS = {topic: f"topic_{topic}" for topic in EXERCISE_TOPICS}
+_TOPIC_BY_CALLBACK = {callback: topic for topic, callback in _TOPIC_CALLBACKS.items()}
+TOPICS_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton(topic, callback_data=callback)] for topic, callback in _TOPIC_CALLBACKS.items()])
+DIFFICULTY_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton(str(i), callback_data=f"diff_{i}") for i in range(1, 6)]])
+DEEPEN_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("No, gracias", callback_data="deepen_no")]])
+NEXT_ACTION_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Otro ejercicio similar", callback_data="next_action_similar")],
+    [InlineKeyboardButton("Regresar al menú principal", callback_data="main_menu")],
+])
+RESOLUTION_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Intentar de nuevo", callback_data="resolution_retry")],
+    [InlineKeyboardButton("Ver la solución", callback_data="resolution_solve")],
+])
+
+# Formato de /asesoria: "<duda> nivel <dificultad>". Anclado y acotado porque el texto viene del usuario
+_DOUBT_RE = re.compile(r'\A(.{1,500}?)\s+nivel\s*(fácil|intermedio|avanzado)[\s.!?]*\Z', re.IGNORECASE | re.DOTALL)
+_DIFFICULTY_MAP = {'fácil': 'básico', 'intermedio': 'detallado', 'avanzado': 'experto'}
+
+# Palabras que indican que Gemini consideró correcta la respuesta del estudiante
+_POSITIVE_RE = re.compile(r'correcto|exacto|perfecto|muy bien|excelente|felicidades', re.IGNORECASE)
+
+EXERCISE_SCHEMA = {"type": "OBJECT", "properties": {"problem": {"type": "STRING"}, "solution": {"type": "STRING"}}}
+EXERCISE_GEN_CONFIG = {"responseMimeType": "application/json", "responseSchema": EXERCISE_SCHEMA}
+
+GEMINI_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
+
+# Cliente HTTP persistente: reutiliza conexiones (keep-alive, HTTP/2) entre llamadas a Gemini
+GEMINI_CLIENT = httpx.AsyncClient(
+    http2=True,
+    headers={"content-type": "application/json"},
+    timeout=httpx.Timeout(30.0, connect=5.0),
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+)
+# Reintentos ante errores transitorios de Gemini (red, 429 y 5xx)
+GEMINI_MAX_ATTEMPTS = 3
+GEMINI_RETRY_STATUS = {429, 500, 502, 503, 504}
+GEMINI_MAX_RETRY_DELAY = 10.0
+# Tiempo total máximo por llamada, sumando todos los intentos y esperas
+GEMINI_TIME_BUDGET = 45.0
+
+# Campos del documento de estado que usa el bot; se leen solo estos de Firestore
+USER_STATE_FIELDS = ["bot_state", "last_asesoria_topic", "current_exercise"]
+
+# Caché en memoria del estado de cada usuario, con expiración y tamaño acotado
+STATE_CACHE_TTL = 300.0
+STATE_CACHE_MAX_USERS = 10_000
+
+class UserStateCache:
+    """Caché LRU con TTL: user_id -> (momento de carga, estado)."""
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: OrderedDict[int, tuple[float, dict]] = OrderedDict()
+
+    def get(self, user_id: int) -> dict | None:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] >= self.ttl:
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return copy.deepcopy(entry[1])
+
+    def put(self, user_id: int, state: dict):
+        self._entries[user_id] = (time.monotonic(), copy.deepcopy(state))
+        self._entries.move_to_end(user_id)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def merge(self, user_id: int, changes: dict):
+        """Aplica cambios parciales a una entrada existente sin alterar su momento de carga."""
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            self._entries[user_id] = (entry[0], {**entry[1], **copy.deepcopy(changes)})
+
+    def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+_STATE_CACHE = UserStateCache(STATE_CACHE_TTL, STATE_CACHE_MAX_USERS)
 
 # --- 3. FUNCIONES AUXILIARES ---
-async def call_gemini_api(prompt: str, is_structured: bool = False, schema: dict = None) -> str | dict | None:
+def _retry_delay(attempt: int, response: httpx.Response | None = None) -> float:
+    """Espera antes del siguiente intento: Retry-After si viene, si no backoff exponencial."""
+    if response is not None:
+        retry_after = response.headers.get("retry-after", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), GEMINI_MAX_RETRY_DELAY)
+    return 0.5 * 2 ** attempt + random.random() * 0.2
+
+async def post_to_gemini(body: bytes) -> httpx.Response:
+    loop = asyncio.get_running_loop()
+    async with asyncio.timeout(GEMINI_TIME_BUDGET) as budget:
+        for attempt in range(GEMINI_MAX_ATTEMPTS):
+            last_attempt = attempt == GEMINI_MAX_ATTEMPTS - 1
+            try:
+                response = await GEMINI_CLIENT.post(GEMINI_URL, content=body)
+            except httpx.TransportError as e:
+                delay = _retry_delay(attempt)
+                # No se reintenta si la espera agotaría el presupuesto de tiempo
+                if last_attempt or loop.time() + delay >= budget.when():
+                    raise
+                logger.warning(f"Error de red con Gemini ({e!r}), reintentando en {delay:.1f}s...")
+            else:
+                if response.status_code not in GEMINI_RETRY_STATUS or last_attempt:
+                    return response
+                delay = _retry_delay(attempt, response)
+                if loop.time() + delay >= budget.when():
+                    return response
+                logger.warning(f"Gemini respondió {response.status_code}, reintentando en {delay:.1f}s...")
+            await asyncio.sleep(delay)
+
+async def call_gemini_api(prompt: str, generation_config: dict | None = None) -> str | dict | None:
     if not GEMINI_API_KEY:
         logger.error("No se encontró la clave de API de Gemini.")
         return "Error: La conexión con la IA no está configurada."
-    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GEMINI_API_KEY}"
     payload = {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
-    if is_structured and schema:
-        payload["generationConfig"] = {"responseMimeType": "application/json", "responseSchema": schema}
+    is_structured = generation_config is not None and generation_config.get("responseMimeType") == "application/json"
+    if generation_config:
+        payload["generationConfig"] = generation_config
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(api_url, json=payload, timeout=60.0)
-            response.raise_for_status()
-            result = response.json()
-        if text_content := result.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text"):
-            return json.loads(text_content) if is_structured else text_content
+        response = await post_to_gemini(orjson.dumps(payload))
+        response.raise_for_status()
+        result = orjson.loads(response.content)
+        try:
+            text_content = result["candidates"][0]["content"]["parts"][0]["text"]
+        except (KeyError, IndexError, TypeError):
+            text_content = None
+        if text_content:
+            return orjson.loads(text_content) if is_structured else text_content
         else:
             logger.error(f"Respuesta inesperada de Gemini: {result}")
             return "Lo siento, no pude generar una respuesta en este momento."
     except httpx.HTTPStatusError as e:
         logger.error(f"Error en la API de Gemini (HTTP): {e.response.text}")
         return "Hubo un problema con la IA. Inténtalo de nuevo más tarde."
+    except TimeoutError:
+        logger.error(f"La API de Gemini no respondió en {GEMINI_TIME_BUDGET:.0f}s.")
+        return "La IA está tardando demasiado en responder. Inténtalo de nuevo."
     except Exception as e:
         logger.error(f"Error al llamar a la API de Gemini: {e}")
         return "Hubo un problema conectando con la IA. Inténtalo de nuevo."
@@ -108,27 +238,67 @@ async def get_user_state(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> di
         if not context.user_data:
             context.user_data.update({"bot_state": "idle", "last_asesoria_topic": None, "current_exercise": None})
         return context.user_data
+    if (cached := _STATE_CACHE.get(user_id)) is not None:
+        return cached
     doc_ref = db.collection("user_states").document(str(user_id))
-    doc = doc_ref.get()
+    doc = await doc_ref.get(field_paths=USER_STATE_FIELDS)
     if doc.exists:
-        return doc.to_dict()
-    return {"bot_state": "idle", "last_asesoria_topic": None, "current_exercise": None}
+        state = doc.to_dict()
+    else:
+        state = {"bot_state": "idle", "last_asesoria_topic": None, "current_exercise": None}
+    _STATE_CACHE.put(user_id, state)
+    return state
 
-async def set_user_state(user_id: int, state: dict, context: ContextTypes.DEFAULT_TYPE):
+async def set_user_state(user_id: int, state: dict, context: ContextTypes.DEFAULT_TYPE, fields: set[str] | None = None):
     if not db:
         context.user_data.update(state)
         return
     doc_ref = db.collection("user_states").document(str(user_id))
-    doc_ref.set(state)
+    try:
+        if fields is not None:
+            # Solo se envían los campos modificados; si el documento aún no existe se crea completo
+            changes = {field: state[field] for field in fields}
+            try:
+                await doc_ref.update(changes)
+            except NotFound:
+                pass
+            else:
+                # El resto de campos en memoria pueden estar desactualizados: solo se aplican los enviados
+                _STATE_CACHE.merge(user_id, changes)
+                return
+        await doc_ref.set(state)
+    except Exception:
+        # No se sabe si la escritura llegó a aplicarse: la próxima lectura irá a Firestore
+        _STATE_CACHE.invalidate(user_id)
+        raise
+    _STATE_CACHE.put(user_id, state)
+
+@asynccontextmanager
+async def user_state(user_id: int, context: ContextTypes.DEFAULT_TYPE):
+    """Carga el estado una vez y al salir guarda solo los campos que cambiaron."""
+    state = await get_user_state(user_id, context)
+    snapshot = copy.deepcopy(state)
+    yield state
+    dirty = {field for field in state if field not in snapshot or state[field] != snapshot[field]}
+    if dirty:
+        await set_user_state(user_id, state, context, fields=dirty)
 
 async def save_interaction(user_id: int, interaction_type: str, data: dict):
     if not db or not FIREBASE_APP_ID: return
     collection_path = f"artifacts/{FIREBASE_APP_ID}/users/{user_id}/bot_interactions"
     interactions_collection = db.collection(collection_path)
     interaction_data = {"type": interaction_type, "userId": user_id, "timestamp": firestore.SERVER_TIMESTAMP, **data}
-    interactions_collection.add(interaction_data)
+    try:
+        await interactions_collection.add(interaction_data)
+    except Exception as e:
+        logger.error(f"Error al guardar la interacción '{interaction_type}' del usuario {user_id}: {e}")
+        return
     logger.info(f"Interacción '{interaction_type}' guardada para el usuario {user_id}")
 
+def save_interaction_in_background(update: Update, context: ContextTypes.DEFAULT_TYPE, interaction_type: str, data: dict):
+    """Guarda la interacción sin bloquear la respuesta; PTB espera estas tareas al detenerse."""
+    context.application.create_task(save_interaction(update.effective_user.id, interaction_type, data), update=update)
+
 async def send_long_message(message_or_query, text: str):
     MAX_LENGTH = 4096
     reply_method = message_or_query.message.reply_text if hasattr(message_or_query, 'message') else message_or_query.reply_text
@@ -136,25 +306,40 @@ async def send_long_message(message_or_query, text: str):
         await reply_method(text)
         return
     parts = []
-    current_part = ""
+    buf = []
+    buflen = 0
     for line in text.split('\n'):
-        if len(current_part) + len(line) + 1 > MAX_LENGTH:
-            parts.append(current_part)
-            current_part = line
+        if buflen + len(line) + 1 > MAX_LENGTH:
+            parts.append('\n'.join(buf))
+            buf = [line]
+            buflen = len(line)
         else:
-            current_part += '\n' + line
-    parts.append(current_part)
-    for part in parts:
-        if part.strip():
-            await reply_method(part.strip())
+            buf.append(line)
+            buflen += len(line) + 1
+    parts.append('\n'.join(buf))
+    # Los envíos siguen siendo secuenciales: en un mismo chat el orden de las partes importa
+    nonempty_parts = [p for p in (part.strip() for part in parts) if p]
+    for part in nonempty_parts:
+        await reply_method(part)
+
+async def send_typing(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Muestra "escribiendo..."; es solo informativo, así que un fallo no interrumpe el turno."""
+    try:
+        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+    except Exception as e:
+        logger.warning(f"No se pudo enviar la acción de escritura: {e}")
+
+async def call_gemini_with_typing(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt: str, generation_config: dict | None = None) -> str | dict | None:
+    """Consulta a Gemini mientras se muestra el indicador de escritura."""
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(send_typing(update, context))
+        return await call_gemini_api(prompt, generation_config)
 
 async def generate_exercise(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict):
     topic = state['current_exercise']['topic']
     difficulty = state['current_exercise']['difficulty']
-    schema = {"type": "OBJECT", "properties": {"problem": {"type": "STRING"}, "solution": {"type": "STRING"}}}
     prompt = f"Crea un ejercicio de Cálculo Diferencial sobre '{topic}' con dificultad {difficulty}/5. Devuelve JSON con claves 'problem' y 'solution'. Usa texto plano."
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    exercise_data = await call_gemini_api(prompt, is_structured=True, schema=schema)
+    exercise_data = await call_gemini_with_typing(update, context, prompt, generation_config=EXERCISE_GEN_CONFIG)
     if exercise_data and "problem" in exercise_data:
         state["bot_state"] = "waiting_for_exercise_answer"
         state["current_exercise"].update(exercise_data)
@@ -162,7 +347,6 @@ async def generate_exercise(update: Update, context: ContextTypes.DEFAULT_TYPE,
     else:
         await update.effective_message.reply_text("No pude generar un ejercicio. Inténtalo de nuevo con /prueba.")
         state["bot_state"] = "idle"
-    await set_user_state(update.effective_user.id, state, context)
 
 
 # --- 4. MANEJADORES DE COMANDOS ---
@@ -181,28 +365,23 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(welcome_text)
 
 async def asesoria_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    state = await get_user_state(update.effective_user.id, context)
-    state["bot_state"] = "waiting_for_doubt"
-    await set_user_state(update.effective_user.id, state, context)
+    async with user_state(update.effective_user.id, context) as state:
+        state["bot_state"] = "waiting_for_doubt"
     await update.message.reply_text("Por favor, dime tu duda y el nivel de dificultad. \nEj: '¿Qué es la derivada? nivel Fácil'")
 
 async def ejemplo_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    state = await get_user_state(update.effective_user.id, context)
-    state["bot_state"] = "waiting_for_example_topic"
-    await set_user_state(update.effective_user.id, state, context)
+    async with user_state(update.effective_user.id, context) as state:
+        state["bot_state"] = "waiting_for_example_topic"
     await update.message.reply_text("¡Claro! ¿Sobre qué tema de Cálculo Diferencial te gustaría un ejemplo?")
 
 async def prueba_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    state = await get_user_state(update.effective_user.id, context)
-    state["bot_state"] = "waiting_for_exercise_topic"
-    await set_user_state(update.effective_user.id, state, context)
-    keyboard = [[InlineKeyboardButton(topic, callback_data=f"topic_{topic}")] for topic in EXERCISE_TOPICS]
-    await update.message.reply_text("¡Excelente! Elige el tema:", reply_markup=InlineKeyboardMarkup(keyboard))
+    async with user_state(update.effective_user.id, context) as state:
+        state["bot_state"] = "waiting_for_exercise_topic"
+    await update.message.reply_text("¡Excelente! Elige el tema:", reply_markup=TOPICS_KEYBOARD)
 
 async def dudas_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    state = await get_user_state(update.effective_user.id, context)
-    state["bot_state"] = "waiting_for_duda_cuaderno"
-    await set_user_state(update.effective_user.id, state, context)
+    async with user_state(update.effective_user.id, context) as state:
+        state["bot_state"] = "waiting_for_duda_cuaderno"
     await update.message.reply_text(
         "Has entrado a la sección de ayuda para el Cuaderno Digital.\n\n"
         "Por favor, escribe tu pregunta sobre cualquier parte del cuaderno y te ayudaré a resolverla."
@@ -213,114 +392,116 @@ async def encuesta_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "¡Gracias por ayudarme a mejorar! Tu opinión es muy valiosa.\n\n"
         "Por favor, completa la siguiente encuesta:\nhttps://forms.gle/dtyB5o2FncCA7zMy7"
     )
-    await save_interaction(update.effective_user.id, 'encuesta_link_sent', {'link': 'https://forms.gle/dtyB5o2FncCA7zMy7'})
+    save_interaction_in_background(update, context, 'encuesta_link_sent', {'link': 'https://forms.gle/dtyB5o2FncCA7zMy7'})
 
 # --- 5. MANEJADOR DE MENSAJES DE TEXTO ---
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text
-    state = await get_user_state(user_id, context)
-    bot_state = state.get("bot_state", "idle")
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-
-    if bot_state == "waiting_for_duda_cuaderno":
-        prompt = f"{CUADERNO_CONTEXT}\n\n---\n\nBasado en el contexto anterior del 'Cuaderno Digital', responde la siguiente duda del estudiante de la manera más clara y útil posible:\n\nPREGUNTA DEL ESTUDIANTE: '{text}'"
-        bot_response = await call_gemini_api(prompt)
-        await send_long_message(update.message, bot_response)
-        await save_interaction(user_id, 'duda_cuaderno', {'pregunta': text, 'respuesta': bot_response})
-        await update.message.reply_text("¿Tienes alguna otra duda sobre el cuaderno?", reply_markup=MAIN_MENU_KEYBOARD)
-        
-    elif bot_state == "waiting_for_doubt":
-        match = re.search(r'(.+)\s+nivel\s*(fácil|intermedio|avanzado)', text, re.IGNORECASE)
-        if match:
-            doubt, difficulty = match.groups()
-            difficulty_map = {'fácil': 'básico', 'intermedio': 'detallado', 'avanzado': 'experto'}
-            prompt = f'Eres un tutor experto en Cálculo Diferencial. Explica: "{doubt.strip()}". Nivel: {difficulty_map[difficulty.lower()]}. Usa texto plano (ej: x^2).'
-            bot_response = await call_gemini_api(prompt)
+    async with user_state(user_id, context) as state:
+        bot_state = state.get("bot_state", "idle")
+
+        if bot_state == "waiting_for_duda_cuaderno":
+            prompt = f"{CUADERNO_PROMPT_PREFIX}'{text}'"
+            bot_response = await call_gemini_with_typing(update, context, prompt)
             await send_long_message(update.message, bot_response)
-            await save_interaction(user_id, 'asesoria', {'query': doubt, 'difficulty': difficulty, 'response': bot_response})
-            state.update({"bot_state": "waiting_for_deepen_topic", "last_asesoria_topic": doubt})
-            keyboard = [[InlineKeyboardButton("No, gracias", callback_data="deepen_no")]]
-            await update.message.reply_text("¿Quieres profundizar en algo más?", reply_markup=InlineKeyboardMarkup(keyboard))
-        else:
-            await update.message.reply_text("Formato incorrecto. Ejemplo: '¿Qué es la derivada? nivel Fácil'")
+            save_interaction_in_background(update, context, 'duda_cuaderno', {'pregunta': text, 'respuesta': bot_response})
+            await update.message.reply_text("¿Tienes alguna otra duda sobre el cuaderno?", reply_markup=MAIN_MENU_KEYBOARD)
+        
+        elif bot_state == "waiting_for_doubt":
+            match = _DOUBT_RE.match(text)
+            if match:
+                doubt, difficulty = match.groups()
+                prompt = f'Eres un tutor experto en Cálculo Diferencial. Explica: "{doubt.strip()}". Nivel: {_DIFFICULTY_MAP[difficulty.lower()]}. Usa texto plano (ej: x^2).'
+                bot_response = await call_gemini_with_typing(update, context, prompt)
+                await send_long_message(update.message, bot_response)
+                save_interaction_in_background(update, context, 'asesoria', {'query': doubt, 'difficulty': difficulty, 'response': bot_response})
+                state.update({"bot_state": "waiting_for_deepen_topic", "last_asesoria_topic": doubt})
+                await update.message.reply_text("¿Quieres profundizar en algo más?", reply_markup=DEEPEN_KEYBOARD)
+            else:
+                await update.message.reply_text("Formato incorrecto. Ejemplo: '¿Qué es la derivada? nivel Fácil'")
             
-    elif bot_state == "waiting_for_deepen_topic":
-        prompt = f'Eres un tutor experto. Profundiza en "{text.strip()}" en el contexto de "{state.get("last_asesoria_topic", "Cálculo Diferencial")}".'
-        bot_response = await call_gemini_api(prompt)
-        await send_long_message(update.message, bot_response)
-        await save_interaction(user_id, 'profundizar_asesoria', {'original': state.get("last_asesoria_topic"), 'deepen': text.strip(), 'response': bot_response})
-        keyboard = [[InlineKeyboardButton("No, gracias", callback_data="deepen_no")]]
-        await update.message.reply_text("¿Quieres profundizar en algo más?", reply_markup=InlineKeyboardMarkup(keyboard))
+        elif bot_state == "waiting_for_deepen_topic":
+            prompt = f'Eres un tutor experto. Profundiza en "{text.strip()}" en el contexto de "{state.get("last_asesoria_topic", "Cálculo Diferencial")}".'
+            bot_response = await call_gemini_with_typing(update, context, prompt)
+            await send_long_message(update.message, bot_response)
+            save_interaction_in_background(update, context, 'profundizar_asesoria', {'original': state.get("last_asesoria_topic"), 'deepen': text.strip(), 'response': bot_response})
+            await update.message.reply_text("¿Quieres profundizar en algo más?", reply_markup=DEEPEN_KEYBOARD)
         
-    elif bot_state == "waiting_for_example_topic":
-        prompt = f'Proporciona un ejemplo práctico y resuelto sobre "{text.strip()}" en Cálculo Diferencial. Explícalo paso a paso. Usa texto plano.'
-        bot_response = await call_gemini_api(prompt)
-        await send_long_message(update.message, bot_response)
-        await save_interaction(user_id, 'ejemplo', {'topic': text.strip(), 'response': bot_response})
-        state["bot_state"] = "idle"
-        await update.message.reply_text("Espero que el ejemplo haya sido útil.", reply_markup=MAIN_MENU_KEYBOARD)
-
-    elif bot_state == "waiting_for_exercise_answer":
-        exercise = state.get("current_exercise", {})
-        prompt = f"""Evalúa esta respuesta de un estudiante de Cálculo.
-        - Problema: "{exercise.get('problem')}"
-        - Solución Correcta: "{exercise.get('solution')}"
-        - Respuesta del Estudiante: "{text.strip()}"
-        Si es correcta, felicita y ASEGÚRATE de incluir la palabra "correcto". Si no, da una pista SIN revelar la solución. Usa texto plano."""
-        verification = await call_gemini_api(prompt)
-        await send_long_message(update.message, verification)
-        await save_interaction(user_id, 'verificacion_ejercicio', {**exercise, 'user_answer': text.strip(), 'verification': verification})
-        positive_keywords = ['correcto', 'exacto', 'perfecto', 'muy bien', 'excelente', 'felicidades']
-        if any(keyword in verification.lower() for keyword in positive_keywords):
-            keyboard = [[InlineKeyboardButton("Otro ejercicio similar", callback_data="next_action_similar")], [InlineKeyboardButton("Regresar al menú principal", callback_data="main_menu")]]
-            await update.message.reply_text("¿Qué te gustaría hacer ahora?", reply_markup=InlineKeyboardMarkup(keyboard))
-            state["bot_state"] = "waiting_for_next_action"
-        else:
-            keyboard = [[InlineKeyboardButton("Intentar de nuevo", callback_data="resolution_retry")], [InlineKeyboardButton("Ver la solución", callback_data="resolution_solve")]]
-            await update.message.reply_text("¿Qué quieres hacer?", reply_markup=InlineKeyboardMarkup(keyboard))
-            state["bot_state"] = "waiting_for_exercise_resolution"
-
-    await set_user_state(user_id, state, context)
+        elif bot_state == "waiting_for_example_topic":
+            prompt = f'Proporciona un ejemplo práctico y resuelto sobre "{text.strip()}" en Cálculo Diferencial. Explícalo paso a paso. Usa texto plano.'
+            bot_response = await call_gemini_with_typing(update, context, prompt)
+            await send_long_message(update.message, bot_response)
+            save_interaction_in_background(update, context, 'ejemplo', {'topic': text.strip(), 'response': bot_response})
+            state["bot_state"] = "idle"
+            await update.message.reply_text("Espero que el ejemplo haya sido útil.", reply_markup=MAIN_MENU_KEYBOARD)
+
+        elif bot_state == "waiting_for_exercise_answer":
+            exercise = state.get("current_exercise", {})
+            prompt = f"""Evalúa esta respuesta de un estudiante de Cálculo.
+            - Problema: "{exercise.get('problem')}"
+            - Solución Correcta: "{exercise.get('solution')}"
+            - Respuesta del Estudiante: "{text.strip()}"
+            Si es correcta, felicita y ASEGÚRATE de incluir la palabra "correcto". Si no, da una pista SIN revelar la solución. Usa texto plano."""
+            verification = await call_gemini_with_typing(update, context, prompt)
+            await send_long_message(update.message, verification)
+            save_interaction_in_background(update, context, 'verificacion_ejercicio', {**exercise, 'user_answer': text.strip(), 'verification': verification})
+            if _POSITIVE_RE.search(verification):
+                await update.message.reply_text("¿Qué te gustaría hacer ahora?", reply_markup=NEXT_ACTION_KEYBOARD)
+                state["bot_state"] = "waiting_for_next_action"
+            else:
+                await update.message.reply_text("¿Qué quieres hacer?", reply_markup=RESOLUTION_KEYBOARD)
+                state["bot_state"] = "waiting_for_exercise_resolution"
 
 # --- 6. MANEJADOR DE CLICS EN BOTONES ---
+async def _handle_topic(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict, action: str):
+    topic = _TOPIC_BY_CALLBACK.get(action) or action[len("topic_"):]
+    state.update({"bot_state": "waiting_for_exercise_difficulty", "current_exercise": {"topic": topic}})
+    await update.callback_query.edit_message_text(f"Tema: {topic}. Elige dificultad:", reply_markup=DIFFICULTY_KEYBOARD)
+
+async def _handle_diff(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict, action: str):
+    difficulty = int(action[len("diff_"):])
+    state["current_exercise"]["difficulty"] = difficulty
+    await update.callback_query.edit_message_text(f"OK. Generando ejercicio de {state['current_exercise']['topic']} (Nivel {difficulty})...")
+    await generate_exercise(update, context, state)
+
+async def _handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict, action: str):
+    state.update({"bot_state": "idle", "last_asesoria_topic": None})
+    await update.callback_query.edit_message_text("De acuerdo, volviendo al menú principal. Usa /start para ver las opciones.")
+
+async def _handle_next_similar(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict, action: str):
+    await update.callback_query.edit_message_text("¡Perfecto! Generando otro ejercicio...")
+    await generate_exercise(update, context, state)
+
+async def _handle_retry(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict, action: str):
+    state["bot_state"] = "waiting_for_exercise_answer"
+    await update.callback_query.edit_message_text("¡Claro! Tómate tu tiempo y escribe tu nueva respuesta.")
+
+async def _handle_solve(update: Update, context: ContextTypes.DEFAULT_TYPE, state: dict, action: str):
+    state["bot_state"] = "idle"
+    solution = state.get("current_exercise", {}).get("solution", "No se encontró la solución.")
+    await update.callback_query.edit_message_text(f"La solución es:\n\n{solution}", reply_markup=MAIN_MENU_KEYBOARD)
+
+# callback_data exacto o prefijo (terminado en "_") -> manejador
+CALLBACK_HANDLERS = {
+    "topic_": _handle_topic,
+    "diff_": _handle_diff,
+    "deepen_no": _handle_main_menu,
+    "main_menu": _handle_main_menu,
+    "next_action_similar": _handle_next_similar,
+    "resolution_retry": _handle_retry,
+    "resolution_solve": _handle_solve,
+}
+
 async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    user_id = query.from_user.id
-    state = await get_user_state(user_id, context)
     action = query.data
-
-    if action.startswith("topic_"):
-        topic = action.split("_", 1)[1]
-        state.update({"bot_state": "waiting_for_exercise_difficulty", "current_exercise": {"topic": topic}})
-        keyboard = [[InlineKeyboardButton(str(i), callback_data=f"diff_{i}") for i in range(1, 6)]]
-        await query.edit_message_text(f"Tema: {topic}. Elige dificultad:", reply_markup=InlineKeyboardMarkup(keyboard))
-        
-    elif action.startswith("diff_"):
-        difficulty = int(action.split("_", 1)[1])
-        state["current_exercise"]["difficulty"] = difficulty
-        await query.edit_message_text(f"OK. Generando ejercicio de {state['current_exercise']['topic']} (Nivel {difficulty})...")
-        await generate_exercise(update, context, state)
-
-    elif action == "deepen_no" or action == "main_menu":
-        state.update({"bot_state": "idle", "last_asesoria_topic": None})
-        await query.edit_message_text("De acuerdo, volviendo al menú principal. Usa /start para ver las opciones.")
-    
-    elif action == "next_action_similar":
-        await query.edit_message_text("¡Perfecto! Generando otro ejercicio...")
-        await generate_exercise(update, context, state) 
-
-    elif action == "resolution_retry":
-        state["bot_state"] = "waiting_for_exercise_answer"
-        await query.edit_message_text("¡Claro! Tómate tu tiempo y escribe tu nueva respuesta.")
-        
-    elif action == "resolution_solve":
-        state["bot_state"] = "idle"
-        solution = state.get("current_exercise", {}).get("solution", "No se encontró la solución.")
-        await query.edit_message_text(f"La solución es:\n\n{solution}", reply_markup=MAIN_MENU_KEYBOARD)
-
-    await set_user_state(user_id, state, context)
+    handler = CALLBACK_HANDLERS.get(action) or CALLBACK_HANDLERS.get(action[:action.find("_") + 1])
+    if handler is None:
+        return
+    async with user_state(query.from_user.id, context) as state:
+        await handler(update, context, state, action)
 
 # --- 7. MANEJADOR DE ERRORES ---
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -332,13 +513,60 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
             logger.error(f"No se pudo enviar el mensaje de error al usuario: {e}")
 
 # --- 8. FUNCIÓN PRINCIPAL ---
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Procesa en paralelo las actualizaciones de usuarios distintos, pero las de un mismo
+    usuario una a una y en el orden de llegada, ya que el estado se lee al inicio y se guarda al final."""
+
+    # Límite del semáforo interno de PTB: solo evita acumulaciones extremas. La concurrencia real
+    # la controla self._slots, que se toma después del candado del usuario para que las
+    # actualizaciones en espera de un mismo usuario no ocupen plazas de los demás.
+    PTB_QUEUE_LIMIT = 65_536
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(self.PTB_QUEUE_LIMIT)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        # El candado se libera solo cuando ninguna actualización del usuario lo está usando
+        self._user_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+        lock = self._user_locks.get(user.id)
+        if lock is None:
+            lock = self._user_locks[user.id] = asyncio.Lock()
+        async with lock:
+            async with self._slots:
+                await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+async def close_gemini_client(application: Application) -> None:
+    """Cierra el cliente HTTP compartido al apagar el bot."""
+    await GEMINI_CLIENT.aclose()
+
 def main():
     """Configura y ejecuta el bot, adaptándose al entorno."""
     if not TELEGRAM_TOKEN:
         logger.critical("No se encontró el TELEGRAM_TOKEN. El bot no puede iniciar.")
         return
 
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        # Atiende a varios usuarios a la vez para que una espera a Gemini no bloquee a los demás
+        .concurrent_updates(PerUserUpdateProcessor(256))
+        .get_updates_request(HTTPXRequest(connection_pool_size=64))
+        .request(HTTPXRequest(connection_pool_size=256, connect_timeout=5, read_timeout=30))
+        .post_shutdown(close_gemini_client)
+        .build()
+    )
 
     # Registra todos los manejadores
     application.add_handler(CommandHandler("start", start_command))